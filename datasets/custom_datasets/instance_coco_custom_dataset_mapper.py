@@ -3,115 +3,182 @@
 # Modified by Jitesh Jain (https://github.com/praeclarumjj3)
 # ------------------------------------------------------------------------------
 
-import copy
+import functools
+import io
 import logging
 
 import numpy as np
 import torch
-import cv2
+from PIL import Image
+from torch.nn import functional as F
 from detectron2.data import MetadataCatalog
 from detectron2.config import configurable
 from detectron2.structures import Instances, Boxes, BitMasks
-from detectron2.structures import BoxMode
 from detectron2.data import detection_utils as utils
 from detectron2.data import transforms as T
 from detectron2.data.transforms import BigCopyPasteAugmentation
 from oneformer.data.tokenizer import SimpleTokenizer, Tokenize
 from pycocotools import mask as coco_mask
 from pycocotools.coco import COCO
+from detectron2.utils.file_io import PathManager
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJPF_BGR
+    _turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # PyTurboJPEG or libjpeg-turbo is not installed
+    _turbo_jpeg = None
 
 __all__ = ["InstanceCOCOCustomNewBaselineDatasetMapper"]
 
 
 def convert_coco_poly_to_mask(segmentations, height, width):
-    masks = []
-    for polygons in segmentations:
-        rles = coco_mask.frPyObjects(polygons, height, width)
-        mask = coco_mask.decode(rles)
-        if len(mask.shape) < 3:
-            mask = mask[..., None]
-        mask = torch.as_tensor(mask, dtype=torch.uint8)
-        mask = mask.any(dim=2)
-        masks.append(mask)
-    if masks:
-        masks = torch.stack(masks, dim=0)
-    else:
-        masks = torch.zeros((0, height, width), dtype=torch.uint8)
-    return masks
+    # merge each instance's polygons into one RLE in C and decode them all at once
+    rles = [coco_mask.merge(coco_mask.frPyObjects(polygons, height, width)) for polygons in segmentations]
+    if not rles:
+        return torch.zeros((0, height, width), dtype=torch.uint8)
+    masks = coco_mask.decode(rles)  # (H, W, N)
+    return torch.from_numpy(masks).permute(2, 0, 1).to(torch.bool).contiguous()
 
 def convert_coco_poly_to_mask_(segmentations, height, width):
-    masks_ = []
-    masks = []
-    for polygons in segmentations:
-        
-        if isinstance(polygons, list) and all(isinstance(p, float) for p in polygons):
-            masks_.append(polygons)
-        
-        elif isinstance(polygons, list) and all(isinstance(p, list) for p in polygons):
-            # already list of list
-            masks_.extend(polygons)
-        elif isinstance(polygons, np.ndarray):
-            masks_.append(polygons.tolist())
+    """
+    Decode the polygons of several instances with a single pycocotools call.
+
+    Args:
+        segmentations: list with one entry per instance, each either a flat
+            polygon, a list of polygons or an ndarray polygon.
+
+    Returns:
+        bool ndarray of shape (N, H, W), one merged mask per instance.
+    """
+    polygons = []
+    counts = []
+    for segm in segmentations:
+        if isinstance(segm, np.ndarray):
+            segm = [segm.reshape(-1).tolist()]
+        elif isinstance(segm, list):
+            if len(segm) > 0 and not isinstance(segm[0], (list, np.ndarray)):
+                segm = [segm]
         else:
-            raise ValueError(f"Unexpected polygon format: {type(polygons)}")
-        
-        rles = coco_mask.frPyObjects(masks_, height, width)
-        mask = coco_mask.decode(rles)
-        if len(mask.shape) < 3:
-            mask = mask[..., None]
-        mask = torch.as_tensor(mask, dtype=torch.uint8)
-        mask = mask.any(dim=2)
-        if mask.shape != (height, width):
-            # 자동 resize
-            mask = torch.from_numpy(cv2.resize(mask.numpy().astype(np.uint8), (width, height), interpolation=cv2.INTER_NEAREST))
-
-        masks.append(mask)
-    if len(masks) == 1: 
-        masks = np.expand_dims(masks[0], axis=0)
-    elif masks:
-        masks = torch.stack(masks, dim=0)
-    else:
-        masks = torch.zeros((0, height, width), dtype=torch.uint8)
+            raise ValueError(f"Unexpected polygon format: {type(segm)}")
+        polygons.extend(segm)
+        counts.append(len(segm))
+
+    masks = np.zeros((len(counts), height, width), dtype=bool)
+    if polygons:
+        rles = coco_mask.frPyObjects(polygons, height, width)
+        decoded = coco_mask.decode(rles)  # (H, W, sum(counts))
+        offsets = np.cumsum([0] + counts)
+        for i in range(len(counts)):
+            np.any(decoded[..., offsets[i]:offsets[i + 1]], axis=-1, out=masks[i])
     return masks
 
-def binary_masks_to_polygons(masks, tolerance=1.0):
+def _as_mask_stack(masks, height, width):
+    """
+    Stack a sequence of per-instance binary masks, each shaped (H, W) or (1, H, W)
+    as a numpy array or tensor, into a single (N, H, W) uint8 array.
+    Masks are never resized: polygons are rasterized at (H, W) already, so a
+    size mismatch means the annotations do not belong to this image.
     """
-    Convert binary masks to COCO polygon format.
+    if len(masks) == 0:
+        return np.zeros((0, height, width), dtype=np.uint8)
+    stacked = []
+    for m in masks:
+        m = np.asarray(m, dtype=np.uint8)
+        if m.shape[-2:] != (height, width):
+            raise ValueError(
+                f"Mask of shape {m.shape} does not match image size {(height, width)}"
+            )
+        stacked.append(m.reshape(height, width))
+    return np.stack(stacked)
 
-    Args:
-        masks: list of binary masks (H, W) or a tensor (N, H, W)
-        tolerance: approximation tolerance for contour (higher → simpler polygons)
+def _nearest_indices(size, new_size):
+    """
+    Source indices of a nearest-neighbour resize from `size` to `new_size`, sampling
+    at pixel centres like PIL's NEAREST (used by :class:`ResizeTransform`), so that
+    masks stay aligned with the resized image.
+    """
+    scale = size / new_size
+    indices = ((torch.arange(new_size, dtype=torch.float64) + 0.5) * scale).long()
+    return indices.clamp_(max=size - 1)
+
+def _transform_masks(transforms, masks, image_shape):
+    """
+    Apply the geometric transforms to an (N, H, W) uint8 mask stack. Flips, crops,
+    pads and resizes are applied to the whole stack at once; other transforms fall
+    back to :meth:`Transform.apply_segmentation` on each mask.
 
     Returns:
-        List of polygons (as list[list[float]])
+        uint8 tensor of shape (N, H', W'), with (H', W') = image_shape.
+    """
+    masks = torch.from_numpy(masks)
+    if len(masks) == 0:
+        return masks.new_zeros((0,) + tuple(image_shape))
+
+    for t in transforms.transforms:
+        if isinstance(t, T.NoOpTransform):
+            continue
+        elif isinstance(t, T.HFlipTransform):
+            masks = torch.flip(masks, dims=[-1])
+        elif isinstance(t, T.VFlipTransform):
+            masks = torch.flip(masks, dims=[-2])
+        elif isinstance(t, T.CropTransform):
+            masks = masks[:, t.y0 : t.y0 + t.h, t.x0 : t.x0 + t.w]
+        elif isinstance(t, T.PadTransform):
+            # seg_pad_value is the semantic ignore label; instance masks pad with 0
+            masks = F.pad(masks, (t.x0, t.x1, t.y0, t.y1), value=0)
+        elif isinstance(t, T.ResizeTransform):
+            # identity resizes (e.g. min_scale == max_scale == 1) are skipped
+            h, w = masks.shape[-2:]
+            if (t.new_h, t.new_w) != (h, w):
+                masks = masks.index_select(1, _nearest_indices(h, t.new_h)).index_select(
+                    2, _nearest_indices(w, t.new_w)
+                )
+        else:
+            # apply_segmentation fills any padding with seg_pad_value (the semantic
+            # ignore label, e.g. 255); instance masks must stay 0 outside the image
+            masks = torch.from_numpy(
+                np.stack([t.apply_segmentation(m) == 1 for m in masks.numpy()]).view(np.uint8)
+            )
+    return masks.contiguous()
+
+def _read_image(file_name, format):
+    """
+    Same as :func:`detection_utils.read_image`, but decodes RGB/BGR JPEGs with
+    libjpeg-turbo when PyTurboJPEG is available. libjpeg-turbo ignores EXIF
+    orientation, so images with a non-default orientation tag still go through
+    :func:`detection_utils.read_image`.
+    """
+    if (
+        _turbo_jpeg is not None
+        and format in ("RGB", "BGR")
+        and file_name.lower().endswith((".jpg", ".jpeg"))
+    ):
+        with PathManager.open(file_name, "rb") as f:
+            data = f.read()
+        try:
+            # Image.open only parses the header here, the pixels are not decoded
+            orientation = Image.open(io.BytesIO(data)).getexif().get(utils._EXIF_ORIENT, 1)
+        except Exception:
+            # malformed EXIF blocks raise all sorts of errors, see
+            # detection_utils._apply_exif_orientation
+            orientation = None
+        if orientation == 1:
+            try:
+                return _turbo_jpeg.decode(
+                    data, pixel_format=TJPF_RGB if format == "RGB" else TJPF_BGR
+                )
+            except OSError:
+                pass
+    return utils.read_image(file_name, format=format)
+
+@functools.lru_cache(maxsize=None)
+def _get_paste_dataset(json_file, image_root):
+    """
+    Parse the copy-paste source annotations once per process, so that every
+    mapper (and every forked DataLoader worker) shares the same COCO index.
     """
-    polygons_list = []
-
-    for mask_np in masks:
-        if isinstance(mask_np, torch.Tensor):
-            mask_np = mask_np.cpu().numpy()
-        if mask_np.ndim == 3:
-            mask_np = mask_np.squeeze()
-        if mask_np.dtype != np.uint8:
-            mask_np = mask_np.astype(np.uint8)
-
-        mask_np = np.asfortranarray(mask_np.astype(np.uint8))
-        contours, _ = cv2.findContours(mask_np, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        polygons = []
-        for contour in contours:
-            contour = contour.squeeze(1)  # shape: (N, 2)
-            if len(contour) < 3:
-                continue
-            # polygon = contour.flatten().tolist()
-            polygon = [float(x) for x in contour.flatten()]
-            # COCO requires all polygons to have even length and >=6
-            if len(polygon) >= 6:
-                polygons.append(polygon)
-
-        polygons_list.append(polygons)
-
-    return polygons_list
+    return COCO(json_file), image_root
 
 def build_transform_gen(cfg, is_train):
     """
@@ -156,6 +223,21 @@ class InstanceCOCOCustomNewBaselineDatasetMapper:
     2. Applies geometric transforms to the image and annotation
     3. Find and applies suitable cropping to the image and annotation
     4. Prepare image and annotation to Tensors
+
+    The returned "image" is a uint8 (C, H, W) tensor; callers are expected to
+    move it to the device before converting and normalizing it, as
+    :class:`OneFormer` does with its pixel mean and std.
+
+    The one-time setup (paste dataset index, tokenizers, metadata) is only
+    amortized if the DataLoader workers are kept alive, so use it with e.g.
+    ``DataLoader(..., num_workers=N, persistent_workers=True, prefetch_factor=4,
+    pin_memory=True)``. The tensors are not pinned here, since pinning inside a
+    worker does not survive the transfer to the main process; the loader's
+    pin_memory thread pins them, and :class:`OneFormer` copies the images to
+    the device with ``non_blocking=True``.
+
+    The mapper pickles without the copy-paste augmentation; each worker
+    rebuilds it from the per-process cache on first use.
     """
 
     @configurable
@@ -195,15 +277,30 @@ class InstanceCOCOCustomNewBaselineDatasetMapper:
         for k,v in self.meta.thing_dataset_id_to_contiguous_id.items():
             self.things.append(v)
         self.class_names = self.meta.thing_classes
+        self.photo_phrases = [f"a photo with a {name}" for name in self.class_names]
         self.text_tokenizer = Tokenize(SimpleTokenizer(), max_seq_len=max_seq_len)
         self.task_tokenizer = Tokenize(SimpleTokenizer(), max_seq_len=task_seq_len)
         self.use_big_copy_paste = True
         if self.use_big_copy_paste:
             meta_aug = MetadataCatalog.get("hanwha_train_aug")
-            paste_dataset = COCO(meta_aug.json_file)
-            paste_img_root = meta_aug.image_root
-            self.bigcopypaste = BigCopyPasteAugmentation(
-                paste_dataset, paste_img_root)
+            self.paste_json_file = meta_aug.json_file
+            self.paste_image_root = meta_aug.image_root
+            # parse once here so that forked workers inherit the cached index
+            _get_paste_dataset(self.paste_json_file, self.paste_image_root)
+        self._bigcopypaste = None
+
+    @property
+    def bigcopypaste(self):
+        if self._bigcopypaste is None:
+            self._bigcopypaste = BigCopyPasteAugmentation(
+                *_get_paste_dataset(self.paste_json_file, self.paste_image_root))
+        return self._bigcopypaste
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # rebuilt lazily in each worker instead of pickling the COCO index
+        state["_bigcopypaste"] = None
+        return state
 
     @classmethod
     def from_config(cls, cfg, is_train=True):
@@ -223,23 +320,19 @@ class InstanceCOCOCustomNewBaselineDatasetMapper:
         }
         return ret
     
-    def _get_texts(self, classes, num_class_obj):
+    def _get_texts(self, classes):
         
-        classes = list(np.array(classes))
         texts = ["an instance photo"] * self.num_queries
         
-        for class_id in classes:
-            cls_name = self.class_names[class_id]
-            num_class_obj[cls_name] += 1
+        classes = torch.as_tensor(classes, dtype=torch.int64)
+        num_class_obj = torch.bincount(classes, minlength=len(self.class_names)).tolist()
         
         num = 0
-        for i, cls_name in enumerate(self.class_names):
-            if num_class_obj[cls_name] > 0:
-                for _ in range(num_class_obj[cls_name]):
-                    if num >= len(texts):
-                        break
-                    texts[num] = f"a photo with a {cls_name}"
-                    num += 1
+        for class_id, count in enumerate(num_class_obj):
+            count = min(count, len(texts) - num)
+            if count > 0:
+                texts[num : num + count] = [self.photo_phrases[class_id]] * count
+                num += count
 
         return texts
     
@@ -251,38 +344,35 @@ class InstanceCOCOCustomNewBaselineDatasetMapper:
         Returns:
             dict: a format that builtin models in detectron2 accept
         """
-        dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
-        image = utils.read_image(dataset_dict["file_name"], format=self.img_format)
+        # it will be modified by code below; only the dict shells are mutated
+        # (fields are replaced, never edited in place), so a deep copy is not needed
+        dataset_dict = dict(dataset_dict)
+        if "annotations" in dataset_dict:
+            dataset_dict["annotations"] = [dict(anno) for anno in dataset_dict["annotations"]]
+        image = _read_image(dataset_dict["file_name"], format=self.img_format)
         utils.check_image_size(dataset_dict, image)
-        annos = dataset_dict.get("annotations", [])
+        # crowd regions are dropped by both paths, so never decode them
+        annos = [obj for obj in dataset_dict.get("annotations", []) if obj.get("iscrowd", 0) == 0]
 
-        if self.use_big_copy_paste and len(annos) > 0:
-            masks = [convert_coco_poly_to_mask_(anno["segmentation"], image.shape[0], image.shape[1]) for anno in annos]
+        use_big_copy_paste = self.use_big_copy_paste and len(annos) > 0
+        if use_big_copy_paste:
+            masks = convert_coco_poly_to_mask_(
+                [anno["segmentation"] for anno in annos], image.shape[0], image.shape[1]
+            )
+            # BigCopyPasteAugmentation takes one bool (1, H, W) array per instance
+            masks = list(masks[:, None])
             boxes = [anno["bbox"] for anno in annos]
             labels = [anno["category_id"] for anno in annos]
             label_dict = {"labels": np.array(labels)}
         # # TODO: get padding mask
         # # by feeding a "segmentation mask" to the same transforms
-        padding_mask = np.ones(image.shape[:2])
-
-        image_, masks, boxes, label_dict = self.bigcopypaste(image, masks, boxes, label_dict )
-        image, transforms = T.apply_transform_gens(self.tfm_gens, image_)
-        new_annotations = []
-        masks = binary_masks_to_polygons(masks)
-        for i in range(len(masks)):
-            x1, y1, x2, y2 = boxes[i]
-            w = x2 - x1
-            h = y2 - y1
-            
-            new_annotations.append({
-                "iscrowd": 0,
-                "bbox": [float(x1), float(y1), float(w), float(h)],
-                "category_id": int(label_dict["labels"][i]),
-                "segmentation": masks[i],
-                "bbox_mode": BoxMode.XYWH_ABS,
-            })
-
-        dataset_dict["annotations"] = new_annotations
+        padding_mask = np.ones(image.shape[:2], dtype=np.uint8)
+
+        if use_big_copy_paste:
+            image, masks, boxes, label_dict = self.bigcopypaste(image, masks, boxes, label_dict)
+            masks = _as_mask_stack(masks, image.shape[0], image.shape[1])
+        image, transforms = T.apply_transform_gens(self.tfm_gens, image)
+
         # the crop transformation has default padding value 0 for segmentation
         padding_mask = transforms.apply_segmentation(padding_mask)
         padding_mask = ~ padding_mask.astype(bool)
@@ -292,31 +382,42 @@ class InstanceCOCOCustomNewBaselineDatasetMapper:
         # Pytorch's dataloader is efficient on torch.Tensor due to shared-memory,
         # but not efficient on large generic data structures due to the use of pickle & mp.Queue.
         # Therefore it's important to use torch.Tensor.
-        dataset_dict["image"] = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
-        dataset_dict["padding_mask"] = torch.as_tensor(np.ascontiguousarray(padding_mask))
+        # The image is kept as uint8; normalization happens on device in the model.
+        image = image.astype(np.uint8, copy=False)
+        dataset_dict["image"] = torch.from_numpy(np.ascontiguousarray(image.transpose(2, 0, 1)))
+        dataset_dict["padding_mask"] = torch.from_numpy(np.ascontiguousarray(padding_mask)).to(torch.bool)
 
         if not self.is_train:
             # USER: Modify this if you want to keep them for some reason.
             dataset_dict.pop("annotations", None)
             return dataset_dict
-        # augmentation 결과 instances에 추가하기 
-        # if len(masks) > 0:
-        #     masks_tensor = BitMasks(torch.stack([torch.from_numpy(m).squeeze(0) for m in masks]))
-        #     masks_tensor = transforms.apply_segmentation(masks_tensor)
-
-        #     boxes_tensor = Boxes(torch.tensor(boxes, dtype=torch.float32))
-        #     boxes_tensor = transforms.apply_box(boxes_tensor.tensor)
-        #     classes_tensor = torch.tensor(label_dict["labels"], dtype=torch.int64)
-
-        #     instances = Instances(image_shape)
-        #     instances.gt_masks = masks_tensor.tensor
-        #     instances.gt_boxes = boxes_tensor
-        #     instances.gt_classes = classes_tensor
-        #     instances = utils.filter_empty_instances(instances)
-        # else:
-        #     instances = utils.annotations_to_instances(annos, image_shape)
 
-        if "annotations" in dataset_dict:
+        if use_big_copy_paste:
+            # The pasted masks are already bitmasks, so transform them directly
+            # instead of tracing them back to polygons and decoding them again.
+            dataset_dict.pop("annotations", None)
+            masks = _transform_masks(transforms, masks, image_shape)
+
+            # Fill the Instances from stacked arrays; boxes are derived from the
+            # transformed masks so they stay consistent with the crop.
+            instances = Instances(image_shape)
+            instances.gt_classes = torch.from_numpy(np.asarray(label_dict["labels"], dtype=np.int64))
+            instances.gt_masks = BitMasks(masks)
+            instances.gt_boxes = instances.gt_masks.get_bounding_boxes()
+            # Need to filter empty instances first (due to augmentation)
+            instances = utils.filter_empty_instances(instances)
+            instances.gt_masks = instances.gt_masks.tensor
+
+        elif len(annos) == 0:
+            # No non-crowd annotations (or none at all): emit empty targets, since
+            # annotations_to_instances would not set gt_masks for an empty list.
+            dataset_dict.pop("annotations", None)
+            instances = Instances(image_shape)
+            instances.gt_classes = torch.zeros((0,), dtype=torch.int64)
+            instances.gt_masks = torch.zeros((0,) + tuple(image_shape), dtype=torch.uint8)
+            instances.gt_boxes = Boxes(torch.zeros((0, 4)))
+
+        elif "annotations" in dataset_dict:
             # USER: Modify this if you want to keep them for some reason.
             for anno in dataset_dict["annotations"]:
                 anno.pop("keypoints", None)
@@ -342,12 +443,8 @@ class InstanceCOCOCustomNewBaselineDatasetMapper:
                 instances.gt_masks = gt_masks
         
 
-        num_class_obj = {}
-        for name in self.class_names:
-            num_class_obj[name] = 0
-
         task = "The task is instance"
-        text = self._get_texts(instances.gt_classes, num_class_obj)
+        text = self._get_texts(instances.gt_classes)
 
         dataset_dict["instances"] = instances
         dataset_dict["orig_shape"] = image_shape